@@ -1,13 +1,26 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 import typing as typ
-import io
-from copy import deepcopy
+import asyncio
+import bisect
+import heapq
+import json
+import os
+import pickle
+import socket
+import struct
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
+from functools import partial
+from operator import itemgetter
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 
 
 datetime_format = "%H:%M:%S %d.%m.%Y"
@@ -51,6 +64,7 @@ class Controls:
 
     HEADER = "Транспортні засоби"
     UPLOAD_FILE = "Обрати файл з транспортними засобами"
+    PREPARE_DOWNLOAD = "Сформувати (журнал)"
     DOWNLOAD = "Завантажити (журнал)"
     CLEAR_ALL = "Очистити (все)"
     CLEAR_CHECKED_IN = "Очистити (повернулись)"
@@ -106,6 +120,9 @@ class VehicleLogs:
     def add(self, item: VehicleLogItem):
         self._logs.append(item)
 
+    def prepend(self, items: typ.List[VehicleLogItem]):
+        self._logs = items + self._logs
+
     @property
     def check_in_time(self):
         return self.last.check_in_time if self.last else None
@@ -136,60 +153,1235 @@ class VehicleLogs:
             yield l
 
 
-def sort_by_check_out_time(df: pd.DataFrame, ascending: bool = False):
-    check_out_df_column = f"{VehicleJournalTable.TIME_CHECK_OUT}_dt"
-    df[check_out_df_column] = pd.to_datetime(df[VehicleJournalTable.TIME_CHECK_OUT])
-    df = df.sort_values(by=check_out_df_column, ascending=ascending)
-    df.drop(columns=check_out_df_column, inplace=True)
-    return df
+class CheckOutIndex:
+    """Journal records `(check out time, seq, plate, record)` kept ordered by
+    check out time, so readers get ordered slices and the latest records
+    without sorting. New check outs are inserted in O(log n) (appended, as a
+    rule); records without check out time go first."""
+
+    def __init__(self) -> None:
+        self._records = []
+        self._seq = 0
+
+    def add(self, plate: str, record: VehicleLogItem):
+        self._seq += 1
+        bisect.insort(self._records, (record.check_out_time or datetime.min,
+                                      self._seq, plate, record))
+
+    def rebuild(self, events):
+        self._records = []
+        for plate, logs in events.items():
+            for record in logs:
+                self._seq += 1
+                self._records.append((record.check_out_time or datetime.min,
+                                      self._seq, plate, record))
+        self._records.sort()
+
+    def merge(self, older: "CheckOutIndex"):
+        """Merge index of `older` records in linear time, they go first among
+        records checked out at the same time"""
+        self._records = older._records + self._records
+        # stable sort of two sorted runs
+        self._records.sort(key=itemgetter(0))
+        self._seq = max(self._seq, older._seq)
+
+    def ordered(self, newest_first: bool = True):
+        """Records `(plate, record)` ordered by check out time"""
+        records = reversed(self._records) if newest_first else self._records
+        for _, _, plate, record in records:
+            yield plate, record
+
+    def latest(self, n: int):
+        """`n` latest records `(plate, record)`, newest first"""
+        return [(plate, record) for _, _, plate, record in reversed(self._records[-n:])]
+
+    def __len__(self):
+        return len(self._records)
+
+
+def parse_time(column: pd.Series) -> pd.Series:
+    return pd.to_datetime(column, format=datetime_format, errors="coerce")
+
 
 # @st.cache(allow_output_mutation=True)
 def load_events(filename,
                 columns_name_mapping):
     events = defaultdict(VehicleLogs)
+    df = pd.DataFrame()
 
     try:
         df = pd.read_csv(filename)
         df.rename(columns=columns_name_mapping, inplace = True)
         df.set_index(VehicleJournalTable.ID)
-        df = sort_by_check_out_time(df, ascending=True)
         df = df.astype(VehicleJournalTable.dtypes())
 
-        for _, row in df.iterrows():
-            try:
-                time_check_in = datetime.strptime(str(row[VehicleJournalTable.TIME_CHECK_IN]),
-                                                  datetime_format)
-            except ValueError as e:
-                time_check_in = None
-            try:
-                time_check_out = datetime.strptime(str(row[VehicleJournalTable.TIME_CHECK_OUT]),
-                                                   datetime_format)
-            except ValueError as e:
-                time_check_out = None
+        # add records ordered by check out time
+        time_check_out = parse_time(df[VehicleJournalTable.TIME_CHECK_OUT]).sort_values(kind="stable")
+        df = df.loc[time_check_out.index]
+        time_check_in = parse_time(df[VehicleJournalTable.TIME_CHECK_IN])
 
-            events[row[VehicleJournalTable.LICENCE_PLATE]].add(VehicleLogItem(time_check_in,
-                                                                   time_check_out))
+        for plate, check_out, check_in in zip(df[VehicleJournalTable.LICENCE_PLATE],
+                                              time_check_out,
+                                              time_check_in):
+            events[plate].add(VehicleLogItem(None if pd.isna(check_in) else check_in.to_pydatetime(),
+                                             None if pd.isna(check_out) else check_out.to_pydatetime()))
     except pd.errors.EmptyDataError as e:
         pass
     return events, df
 
 
-def events_to_df(events, df):
-    events_df = []
-    for _, row in df.iterrows():
-        logs = events[row[VehicleJournalTable.LICENCE_PLATE]]
-        for record in logs:
-            info = deepcopy(row)
-            info[VehicleJournalTable.TIME_CHECK_IN] = TIME_NOT_SET
-            info[VehicleJournalTable.TIME_CHECK_OUT] = TIME_NOT_SET
-            if isinstance(record.check_in_time, datetime):
-                info[VehicleJournalTable.TIME_CHECK_IN] = record.check_in_time.strftime(datetime_format)
+def export_to_excel(rows: typ.Iterable[typ.Sequence],
+                    columns: typ.List[str],
+                    file_name: str,
+                    sheet_key: typ.Callable[[typ.Sequence], str] = None,
+                    sheet_name: str = "Журнал"):
+    """Stream `rows` to Excel file `file_name` in constant memory: each row is
+    flushed to disk as soon as it is written, and columns' widths are
+    tracked as running maxima.
+
+    `sheet_key` maps a row to the name of its sheet (e.g. day of check out),
+    rows of each sheet must come in order.
+    """
+    with xlsxwriter.Workbook(file_name, {"constant_memory": True}) as workbook:
+        sheets = {}
+
+        for row in rows:
+            name = (sheet_key(row) if sheet_key else None) or sheet_name
+            if name not in sheets:
+                worksheet = workbook.add_worksheet(name)
+                worksheet.write_row(0, 0, columns)
+                sheets[name] = [worksheet, 1, [len(str(c)) for c in columns]]
+            sheet = sheets[name]
+
+            worksheet, row_idx, widths = sheet
+            # missing values (NaN) are left blank
+            row = [value if value == value else None for value in row]
+            worksheet.write_row(row_idx, 0, row)
+            for i, value in enumerate(row):
+                if value is not None:
+                    widths[i] = max(widths[i], len(str(value)))
+            sheet[1] += 1
+
+        if len(sheets) == 0:
+            workbook.add_worksheet(sheet_name).write_row(0, 0, columns)
+
+        # Auto-adjust columns' width
+        for worksheet, _, widths in sheets.values():
+            for col_idx, column_width in enumerate(widths):
+                worksheet.set_column(col_idx, col_idx, column_width)
+
+
+class JournalOp:
+    CHECK_OUT = "check_out"
+    CHECK_IN = "check_in"
+    CLEAR = "clear"
+    CLEAR_CHECKED_IN = "clear_checked_in"
+    # not logged: history older than the snapshot is merged
+    LOAD_HISTORY = "load_history"
+
+
+class JournalStore:
+    """Process-wide journal state: `events` per licence plate plus details of
+    the vehicles met in the journal.
+
+    Every change is appended to an operations log (`*.ops`). From time to
+    time a copy of the state is dumped (in a background thread) to a compact
+    binary snapshot (`*.snapshot`) that remembers the position in the
+    operations log it covers. The snapshot keeps only the last record of
+    each vehicle (its state and open trip), so the startup loads it and
+    replays the tail of the log regardless of the journal length. Older
+    records are replayed from the operations log in a background thread and
+    merged (`history_loaded` is set, listeners get `LOAD_HISTORY`). The
+    operations log holds the whole history (when it is created, it is seeded
+    from the journal `log.csv`), so a missing or corrupted snapshot falls
+    back to replaying it from the start.
+
+    `version` is bumped on every change, so sessions can cheaply tell whether
+    what they display is stale; listeners registered with `subscribe` are
+    called after each change with `(version, op, plate)`.
+
+    `index` keeps all records ordered by check out time.
+    """
+
+    SNAPSHOT_MAGIC = b"VJSNAP03"
+    # magic, crc32 of payload, operations log offset, payload length
+    SNAPSHOT_HEADER = struct.Struct("<8sIQQ")
+    SNAPSHOT_EVERY = 100
+
+    def __init__(self, log_file: Path, columns_name_mapping) -> None:
+        self.log_file = Path(log_file)
+        self.ops_file = self.log_file.with_suffix(".ops")
+        self.snapshot_file = self.log_file.with_suffix(".snapshot")
+
+        self.lock = threading.RLock()
+        self.events = defaultdict(VehicleLogs)
+        self.index = CheckOutIndex()
+        self.vehicles = pd.DataFrame()
+        self._ops_since_snapshot = 0
+        # snapshots are dumped outside of `lock`, the latest copy wins
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_seq = 0
+        self._snapshot_written = 0
+
+        self.version = 0
+        self.persisted_version = -1
+        self._listeners = []
+        # licence plates of uploaded rosters
+        self.roster = set()
+
+        self.history_loaded = threading.Event()
+        # clears applied before the history is merged
+        self._clears = []
+
+        with self.lock:
+            ops_offset = self._load_snapshot()
+            if ops_offset is None:
+                # the whole history is replayed
+                self.history_loaded.set()
+                self._rebuild(columns_name_mapping)
+                self.snapshot()
+
+        if not self.history_loaded.is_set():
+            threading.Thread(target=self._load_history, args=(ops_offset,), daemon=True).start()
+
+    def commit(self, ops: typ.Sequence[typ.Tuple[str, str, datetime]]):
+        """Commit a batch of `(op, plate, time)` with a single write to the
+        operations log, raises `ValueError` (nothing is committed) if any
+        operation is invalid"""
+        for op, plate, time in ops:
+            self._validate(op, plate, time)
+
+        with self.lock:
+            self._write(ops)
+
+            for op, plate, time in ops:
+                self._apply(op, plate, time)
+                self.version += 1
+                for listener in list(self._listeners):
+                    listener(self.version, op, plate)
+
+            self._ops_since_snapshot += len(ops)
+            if self._ops_since_snapshot >= self.SNAPSHOT_EVERY:
+                self._snapshot_in_background()
+
+    def check_out(self, plate: str, time: datetime = None):
+        self._commit(JournalOp.CHECK_OUT, plate, time or datetime.now())
+
+    def check_in(self, plate: str, time: datetime = None):
+        self._commit(JournalOp.CHECK_IN, plate, time or datetime.now())
+
+    def clear(self):
+        self._commit(JournalOp.CLEAR)
+
+    def clear_checked_in(self):
+        self._commit(JournalOp.CLEAR_CHECKED_IN)
+
+    def subscribe(self, listener: typ.Callable[[int, str, str], None]):
+        """Register `listener`, returns callable to unsubscribe it"""
+        with self.lock:
+            self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    def persist(self, df: pd.DataFrame, version: int):
+        """Write journal `df` built at `version`, unless a newer one is written
+        already (or the history is not loaded yet)"""
+        with self.lock:
+            if version <= self.persisted_version or not self.history_loaded.is_set():
+                return
+            df.to_csv(str(self.log_file), index=False)
+            self.persisted_version = version
+
+    def set_roster(self, vehicles: pd.DataFrame):
+        """Remember details of roster vehicles, so their history stays in the
+        journal after they are removed from the roster"""
+        with self.lock:
+            # readers only look plates up, new keys are added under the lock
+            for plate in vehicles[VehicleJournalTable.LICENCE_PLATE]:
+                self.events[plate]
+            self.roster.update(vehicles[VehicleJournalTable.LICENCE_PLATE])
+
+            known = set()
+            if len(self.vehicles) > 0:
+                known = set(self.vehicles[VehicleJournalTable.LICENCE_PLATE])
+            new_vehicles = vehicles[~vehicles[VehicleJournalTable.LICENCE_PLATE].isin(known)]
+            if len(new_vehicles) <= 0:
+                return
+
+            self.vehicles = pd.concat([self.vehicles, new_vehicles], ignore_index=True)
+            self._snapshot_in_background()
+
+    def snapshot(self):
+        """Dump the state to the snapshot file (atomically)"""
+        self._write_snapshot(*self._snapshot_state())
+
+    def _snapshot_in_background(self):
+        """Copy the state under the lock, dump it in a thread of its own"""
+        threading.Thread(target=self._write_snapshot, args=self._snapshot_state(),
+                         daemon=True).start()
+
+    def _snapshot_state(self):
+        """Copy of the state, operations log offset it covers and its sequence number"""
+        with self.lock:
+            self._ops_since_snapshot = 0
+            self._snapshot_seq += 1
+            state = {
+                # last records, naive (local) times are kept as they are, as
+                # in the operations log
+                "events": {
+                    plate: (logs.check_out_time, logs.check_in_time)
+                    for plate, logs in self.events.items() if len(logs) > 0
+                },
+                # replaced (not modified) on change
+                "vehicles": self.vehicles,
+            }
+            return state, self._ops_offset(), self._snapshot_seq
+
+    def _write_snapshot(self, state: dict, ops_offset: int, seq: int):
+        with self._snapshot_lock:
+            if seq < self._snapshot_written:
+                # a newer state is dumped already
+                return
+
+            vehicles = state["vehicles"]
+            state["vehicles"] = (list(vehicles.columns),
+                                 list(vehicles.itertuples(index=False, name=None)))
+            payload = zlib.compress(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+            header = self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC,
+                                               zlib.crc32(payload),
+                                               ops_offset,
+                                               len(payload))
+
+            tmp_file = self.snapshot_file.with_suffix(".snapshot.tmp")
+            with open(tmp_file, "wb") as f:
+                f.write(header)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+            self._snapshot_written = seq
+
+    def _commit(self, op: str, plate: str = "", time: datetime = None):
+        self.commit([(op, plate, time)])
+
+    def _write(self, ops: typ.Sequence[typ.Tuple[str, str, datetime]]):
+        lines = ["\t".join([op, plate, time.isoformat() if time else ""]) + "\n"
+                 for op, plate, time in ops]
+        with open(self.ops_file, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _validate(op: str, plate: str, time: datetime):
+        if op in (JournalOp.CHECK_OUT, JournalOp.CHECK_IN):
+            if not isinstance(plate, str) or not plate or "\t" in plate or "\n" in plate:
+                raise ValueError(f"invalid licence plate: {plate!r}")
+            # journal keeps naive (local) times
+            if not isinstance(time, datetime) or time.tzinfo is not None:
+                raise ValueError(f"invalid time: {time!r}")
+        elif op not in (JournalOp.CLEAR, JournalOp.CLEAR_CHECKED_IN):
+            raise ValueError(f"unknown operation: {op!r}")
+
+    def _apply(self, op: str, plate: str, time: datetime):
+        self._apply_events(self.events, op, plate, time)
+        if op == JournalOp.CHECK_OUT:
+            self.index.add(plate, self.events[plate].last)
+        elif op in (JournalOp.CLEAR, JournalOp.CLEAR_CHECKED_IN):
+            if not self.history_loaded.is_set():
+                self._clears.append(op)
+            self.index.rebuild(self.events)
+
+        if op == JournalOp.CLEAR:
+            self.vehicles = self.vehicles.iloc[0:0]
+        elif op == JournalOp.CLEAR_CHECKED_IN and len(self.vehicles) > 0:
+            plates = {p for p, logs in self.events.items() if len(logs) > 0}
+            self.vehicles = self.vehicles[
+                self.vehicles[VehicleJournalTable.LICENCE_PLATE].isin(plates)]
+
+    @staticmethod
+    def _apply_events(events, op: str, plate: str, time: datetime):
+        if op == JournalOp.CHECK_OUT:
+            events[plate].check_out(time)
+        elif op == JournalOp.CHECK_IN:
+            events[plate].check_in(time)
+        elif op == JournalOp.CLEAR:
+            for e in events.values():
+                e.clear()
+        elif op == JournalOp.CLEAR_CHECKED_IN:
+            for e in events.values():
+                e.clear_checked_in()
+
+    def _load_snapshot(self) -> typ.Optional[int]:
+        """Load the snapshot and replay the tail of the operations log,
+        returns the offset the snapshot covers (`None` if it is unusable)"""
+        try:
+            with open(self.snapshot_file, "rb") as f:
+                header = f.read(self.SNAPSHOT_HEADER.size)
+                magic, crc, ops_offset, size = self.SNAPSHOT_HEADER.unpack(header)
+                payload = f.read(size)
+            if magic != self.SNAPSHOT_MAGIC or len(payload) != size or zlib.crc32(payload) != crc:
+                raise ValueError(f"Corrupted snapshot: {self.snapshot_file}")
+            state = pickle.loads(zlib.decompress(payload))
+
+            events = defaultdict(VehicleLogs)
+            for plate, (time_check_out, time_check_in) in state["events"].items():
+                events[plate].add(VehicleLogItem(time_check_in, time_check_out))
+            columns, rows = state["vehicles"]
+            vehicles = pd.DataFrame(rows, columns=columns)
+        except (OSError, ValueError, TypeError, KeyError,
+                struct.error, zlib.error, pickle.UnpicklingError) as e:
+            return None
+
+        self.events, self.vehicles = events, vehicles
+        self.index.rebuild(self.events)
+
+        self._replay(ops_offset)
+        return ops_offset
+
+    def _load_history(self, ops_offset: int):
+        """Merge records older than the last ones of the snapshot (covering
+        `ops_offset`), replayed from the operations log"""
+        history = defaultdict(VehicleLogs)
+        for op, plate, time in self._read_ops(0, ops_offset):
+            self._apply_events(history, op, plate, time)
+
+        # the last records are the ones of the snapshot
+        older = {plate: list(logs)[:-1] for plate, logs in history.items() if len(logs) > 1}
+        older_index = CheckOutIndex()
+        older_index.rebuild(older)
+
+        with self.lock:
+            for op in self._clears:
+                if op == JournalOp.CLEAR:
+                    older = {}
+                else:
+                    older = {plate: [item for item in items if not item.checked_in]
+                             for plate, items in older.items()}
+            for plate, items in older.items():
+                self.events[plate].prepend(items)
+            if self._clears:
+                self.index.rebuild(self.events)
+            else:
+                self.index.merge(older_index)
+
+            self._clears = []
+            self.history_loaded.set()
+            self.version += 1
+            for listener in list(self._listeners):
+                listener(self.version, JournalOp.LOAD_HISTORY, "")
+
+    def _replay(self, offset: int):
+        """Apply operations written after `offset`"""
+        for op, plate, time in self._read_ops(offset):
+            self._apply(op, plate, time)
+            self._ops_since_snapshot += 1
+
+    def _read_ops(self, offset: int, end: int = None):
+        """Operations `(op, plate, time)` written from `offset` up to `end`
+        (the end of the log by default, then a half-written line is dropped)"""
+        if not self.ops_file.exists():
+            return
+
+        with open(self.ops_file, "rb" if end is not None else "r+b") as f:
+            f.seek(offset)
+            while end is None or f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                # drop a half-written line (crash while writing), so that
+                # following operations start on a line of their own
+                if not line.endswith(b"\n"):
+                    if end is None:
+                        f.truncate(f.tell() - len(line))
+                    break
+                try:
+                    op, plate, time = line.decode("utf-8").rstrip("\n").split("\t")
+                    time = datetime.fromisoformat(time) if time else None
+                    self._validate(op, plate, time)
+                except ValueError as e:
+                    # skip a broken line, it must not block the startup
+                    continue
+                yield op, plate, time
+
+    def _rebuild(self, columns_name_mapping):
+        events, df = load_events(str(self.log_file), columns_name_mapping)
+
+        self.events = defaultdict(VehicleLogs)
+        if self.ops_file.exists():
+            self.index.rebuild(self.events)
+            self._replay(0)
+        else:
+            # first start: the journal is the history so far, seed the
+            # operations log with it
+            self.events = events
+            self.index.rebuild(self.events)
+            self._seed()
+
+        # details of vehicles
+        if VehicleJournalTable.LICENCE_PLATE in df.columns:
+            df = df.drop_duplicates(subset=VehicleJournalTable.LICENCE_PLATE, keep="last")
+        self.vehicles = df.reset_index(drop=True)
+
+    def _seed(self):
+        """Write the state as operations (in order of check out)"""
+        ops = []
+        for plate, record in self.index.ordered(newest_first=False):
+            if not record.check_out_time:
+                continue
+            ops.append((JournalOp.CHECK_OUT, plate, record.check_out_time))
+            if record.checked_in:
+                ops.append((JournalOp.CHECK_IN, plate, record.check_in_time))
+        self._write(ops)
+
+    def _ops_offset(self) -> int:
+        return self.ops_file.stat().st_size if self.ops_file.exists() else 0
+
+
+# time to return by group of operation
+RETURN_DEADLINES = {
+    "навчальна": timedelta(hours=8),
+    "транспортна": timedelta(hours=12),
+}
+DEFAULT_RETURN_DEADLINE = timedelta(hours=24)
+
+
+class OverdueTracker:
+    """Open trips ordered by return deadline (check-out time plus deadline of
+    the vehicle's `GROUP_OF_OPERATION`).
+
+    Kept up to date by journal changes in O(log n): trips are pushed to a heap
+    on check-out, and entries of returned vehicles are dropped lazily. Overdue
+    (and next to be overdue) trips are read in deadline order, visiting only
+    the heap entries up to the requested deadline.
+    """
+
+    def __init__(self, journal: JournalStore, deadlines: typ.Dict[str, timedelta] = None) -> None:
+        self.journal = journal
+        self.deadlines = deadlines or RETURN_DEADLINES
+        self._groups = {}
+
+        # (deadline, check out time, plate)
+        self._heap = []
+        # plate -> its valid heap entry
+        self._open = {}
+
+        with self.journal.lock:
+            self._rebuild()
+            self.journal.subscribe(self._on_change)
+
+    def set_groups(self, vehicles: pd.DataFrame):
+        """Update groups of operation (deadlines) from the roster"""
+        groups = dict(zip(vehicles[VehicleJournalTable.LICENCE_PLATE],
+                          vehicles[VehicleJournalTable.GROUP_OF_OPERATION]))
+        with self.journal.lock:
+            if groups == self._groups:
+                return
+            self._groups = groups
+            self._rebuild()
+
+    def overdue(self, now: datetime = None) -> typ.List[typ.Tuple[datetime, datetime, str]]:
+        """Overdue trips `(deadline, check out time, plate)`, most overdue first"""
+        now = now or datetime.now()
+        overdue = []
+        with self.journal.lock:
+            for entry in self._ordered():
+                if entry[0] > now:
+                    break
+                overdue.append(entry)
+        return overdue
+
+    def next_due(self, now: datetime = None):
+        """First trip `(deadline, check out time, plate)` to become overdue after `now`"""
+        now = now or datetime.now()
+        with self.journal.lock:
+            for entry in self._ordered():
+                if entry[0] > now:
+                    return entry
+        return None
+
+    def deadline(self, plate: str) -> timedelta:
+        return self.deadlines.get(self._groups.get(plate), DEFAULT_RETURN_DEADLINE)
+
+    def _ordered(self):
+        """Valid heap entries in deadline order (best-first walk of the heap)"""
+        heap = self._heap
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            entry, i = heapq.heappop(frontier)
+            # identity: a stale entry may be equal to the valid one (check out,
+            # check in and check out again at the same time)
+            if self._open.get(entry[2]) is entry:
+                yield entry
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def _push(self, plate: str, check_out_time: datetime):
+        entry = (check_out_time + self.deadline(plate), check_out_time, plate)
+        self._open[plate] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _remove(self, plate: str):
+        self._open.pop(plate, None)
+        # drop stale entries once they outnumber the valid ones
+        if len(self._heap) > 2 * len(self._open) + 64:
+            self._heap = list(self._open.values())
+            heapq.heapify(self._heap)
+
+    def _rebuild(self):
+        self._open = {}
+        for plate, logs in self.journal.events.items():
+            if len(logs) > 0 and not logs.checked_in and logs.check_out_time:
+                self._open[plate] = (logs.check_out_time + self.deadline(plate),
+                                     logs.check_out_time, plate)
+        self._heap = list(self._open.values())
+        heapq.heapify(self._heap)
+
+    def _on_change(self, version: int, op: str, plate: str):
+        if op == JournalOp.CHECK_OUT:
+            self._push(plate, self.journal.events[plate].check_out_time)
+        elif op == JournalOp.CHECK_IN:
+            self._remove(plate)
+        elif op == JournalOp.CLEAR:
+            self._rebuild()
+
+
+def _trip(check_out_time: datetime, check_in_time: datetime, plate: str) -> tuple:
+    """Returned trip interval, check in is clamped to the check out time"""
+    return check_out_time, max(check_out_time, check_in_time), plate
+
+
+class _IntervalNode:
+    """Node of a centered interval tree: intervals containing `center`, sorted
+    by start (ascending) and by end (descending)"""
+
+    def __init__(self, intervals: list) -> None:
+        endpoints = sorted([i[0] for i in intervals] + [i[1] for i in intervals])
+        self.center = endpoints[len(endpoints) // 2]
+
+        left, right, here = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                left.append(interval)
+            elif interval[0] > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+
+        self.by_start = sorted(here, key=lambda i: i[0])
+        self.by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        self.left = _IntervalNode(left) if left else None
+        self.right = _IntervalNode(right) if right else None
+
+    def stab(self, time: datetime, found: list):
+        node = self
+        while node:
+            if time < node.center:
+                for interval in node.by_start:
+                    if interval[0] > time:
+                        break
+                    found.append(interval)
+                node = node.left
+            else:
+                for interval in node.by_end:
+                    if interval[1] < time:
+                        break
+                    found.append(interval)
+                node = node.right
+
+
+class TripIntervalIndex:
+    """Index of trips `(check out time, check in time, plate)` of the journal
+    for audit queries: who was out at a moment (stabbing) or during a period
+    (overlap). Open trips are treated as extending to now.
+
+    Returned trips are kept in a centered interval tree (stabbing in
+    O(log n + k)) together with a list sorted by check-out time, so overlap
+    is `stab(start)` plus trips that started within the period. Trips closed
+    after the tree was built are kept in a small buffer, merged into the tree
+    when it grows; open trips are kept sorted by check-out time. A repeated
+    check in (e.g. a camera reading the plate again) replaces the returned
+    trip: the old interval is masked until the next merge. A trip checked in
+    before its check out (backdated event) is treated as returned at the
+    check out time.
+    """
+
+    MIN_BUFFER_SIZE = 256
+
+    def __init__(self, journal: JournalStore) -> None:
+        self.journal = journal
+
+        self._tree = None
+        self._by_start = []
+        self._buffer = []
+        # plate -> check out time, and sorted (check out time, plate)
+        self._open = {}
+        self._open_by_start = []
+        # plate -> its last returned trip, and masked (replaced) trips
+        self._last_closed = {}
+        self._removed = Counter()
+        self._stale = True
+
+        with self.journal.lock:
+            self.journal.subscribe(self._on_change)
+
+    def out_at(self, time: datetime) -> typ.List[typ.Tuple[datetime, typ.Optional[datetime], str]]:
+        """Trips `(check out time, check in time, plate)` in progress at `time`,
+        check in time is `None` for open trips"""
+        return self.out_between(time, time)
+
+    def out_between(self, start: datetime, end: datetime):
+        """Trips `(check out time, check in time, plate)` overlapping `[start, end]`"""
+        with self.journal.lock:
+            self._refresh()
+
+            found = []
+            if self._tree:
+                self._tree.stab(start, found)
+            lo = bisect.bisect_right(self._by_start, (start, datetime.max))
+            hi = bisect.bisect_right(self._by_start, (end, datetime.max))
+            found.extend(self._by_start[lo:hi])
+            found.extend(i for i in self._buffer if i[0] <= end and i[1] >= start)
+
+            if start <= datetime.now():
+                hi = bisect.bisect_right(self._open_by_start, (end, chr(0x10FFFF)))
+                found.extend((time, None, plate) for time, plate in self._open_by_start[:hi])
+            return self._unmasked(found)
+
+    def _unmasked(self, intervals: list) -> list:
+        if not self._removed:
+            return intervals
+        removed = Counter(self._removed)
+        unmasked = []
+        for interval in intervals:
+            if removed[interval] > 0:
+                removed[interval] -= 1
+            else:
+                unmasked.append(interval)
+        return unmasked
+
+    def _refresh(self):
+        if self._stale:
+            self._rebuild()
+        elif len(self._buffer) > max(self.MIN_BUFFER_SIZE, int(len(self._by_start) ** 0.5)):
+            self._build(self._unmasked(self._by_start + self._buffer))
+
+    def _build(self, intervals: list):
+        self._by_start = sorted(intervals)
+        self._tree = _IntervalNode(self._by_start) if self._by_start else None
+        self._buffer = []
+        self._removed = Counter()
+
+    def _rebuild(self):
+        intervals, self._open, self._last_closed = [], {}, {}
+        for plate, logs in self.journal.events.items():
+            for item in logs:
+                if not item.check_out_time:
+                    continue
+                if item.checked_in:
+                    intervals.append(_trip(item.check_out_time, item.check_in_time, plate))
+                else:
+                    self._open[plate] = item.check_out_time
+            if logs.last and logs.last.check_out_time and logs.checked_in:
+                self._last_closed[plate] = intervals[-1]
+        self._open_by_start = sorted((time, plate) for plate, time in self._open.items())
+        self._build(intervals)
+        self._stale = False
+
+    def _close(self, plate: str, time: datetime):
+        start = self._open.pop(plate)
+        del self._open_by_start[bisect.bisect_left(self._open_by_start, (start, plate))]
+        trip = _trip(start, time, plate)
+        self._buffer.append(trip)
+        self._last_closed[plate] = trip
+
+    def _check_in_again(self, plate: str, logs: VehicleLogs):
+        """Check in time of the returned trip is overwritten"""
+        if not logs.last:
+            # nothing to check in
+            return
+        trip = _trip(logs.check_out_time, logs.check_in_time, plate)
+        previous = self._last_closed.get(plate)
+        if trip == previous:
+            return
+        if not previous or previous[0] != trip[0]:
+            self._stale = True
+            return
+        self._removed[previous] += 1
+        self._buffer.append(trip)
+        self._last_closed[plate] = trip
+
+    def _on_change(self, version: int, op: str, plate: str):
+        if self._stale:
+            return
+
+        logs = self.journal.events[plate] if plate else None
+        if op == JournalOp.CHECK_OUT:
+            # the previous trip (if still open) is closed at the check out time
+            time = logs.check_out_time
+            if plate in self._open:
+                self._close(plate, time)
+            self._open[plate] = time
+            bisect.insort(self._open_by_start, (time, plate))
+        elif op == JournalOp.CHECK_IN and plate in self._open:
+            self._close(plate, logs.check_in_time)
+        elif op == JournalOp.CHECK_IN:
+            self._check_in_again(plate, logs)
+        else:
+            # trips are removed
+            self._stale = True
+
+
+JOURNAL_REFRESH_INTERVAL = 2  # seconds
+
+
+@st.fragment(run_every=JOURNAL_REFRESH_INTERVAL)
+def watch_journal(journal: JournalStore, overdue: OverdueTracker, jobs: "BackgroundJobs"):
+    """Rerun the app as soon as another session (or device) changes the
+    journal, a background job finishes or a vehicle becomes overdue"""
+    if journal.version != st.session_state.get("journal_version", journal.version):
+        st.rerun()
+
+    if jobs.version != st.session_state.get("jobs_version", jobs.version):
+        st.rerun()
+
+    rendered_at = st.session_state.get("journal_rendered_at")
+    next_due = overdue.next_due(rendered_at) if rendered_at else None
+    if next_due and next_due[0] <= datetime.now():
+        st.rerun()
+
+
+@st.cache_resource
+def open_journal(log_file: str, _columns_name_mapping) -> JournalStore:
+    return JournalStore(Path(log_file), _columns_name_mapping)
+
+
+@st.cache_resource
+def track_overdue(_journal: JournalStore) -> OverdueTracker:
+    return OverdueTracker(_journal)
+
+
+@st.cache_resource
+def index_trips(_journal: JournalStore) -> TripIntervalIndex:
+    return TripIntervalIndex(_journal)
+
+
+class IngestionServer:
+    """HTTP/JSON endpoint for gate devices (plate recognition cameras,
+    barrier controllers), runs in a background thread next to the app.
+
+    `POST /events` accepts a single event or a list of events:
 
-            if isinstance(record.check_out_time, datetime):
-                info[VehicleJournalTable.TIME_CHECK_OUT] = record.check_out_time.strftime(datetime_format)
+        {"plate": "12345A", "action": "check_out", "time": "2022-05-12T03:00:00"}
 
-            events_df.append(info)
-    return events_df
+    `action` is `check_out` or `check_in`, `time` (ISO 8601) is optional.
+    Times with UTC offset are converted to local time. Events for plates
+    missing in the roster are rejected. Accepted events are queued and
+    committed to the journal in batches; when the queue is full the request
+    is rejected with `503` and the device should retry (requests with more
+    events than the queue holds are rejected with `413`). Events that fail
+    to be committed are counted in `dropped`.
+    """
+
+    ACTIONS = (JournalOp.CHECK_OUT, JournalOp.CHECK_IN)
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 500
+    MAX_BODY_SIZE = 1024 * 1024
+    RETRY_AFTER = 1  # seconds
+
+    def __init__(self, journal: JournalStore, host: str, port: int) -> None:
+        self.journal = journal
+        self.host = host
+        self.port = port
+
+        # bind here, so that errors (e.g. port in use) are raised to the caller
+        self._sock = socket.create_server((host, port))
+        self.port = self._sock.getsockname()[1]
+
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="ingestion-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, sock=self._sock))
+        self._loop.create_task(self._consume())
+        self._loop.run_forever()
+
+        # stopped: close connections and the loop
+        server.close()
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+    async def _consume(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            # writing (fsync) blocks, keep accepting requests meanwhile
+            await self._loop.run_in_executor(None, self._commit, batch)
+
+    def _commit(self, batch):
+        try:
+            self.journal.commit(batch)
+        except Exception:
+            # a bad batch must not stop the ingestion, commit what we can
+            for op in batch:
+                try:
+                    self.journal.commit([op])
+                except Exception:
+                    self.dropped += 1
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, path, version = (request_line.split(" ") + ["", "", ""])[:3]
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {"error": "invalid Content-Length"}, close=True)
+                    break
+                if length > self.MAX_BODY_SIZE:
+                    await self._respond(writer, 413, {"error": "request is too large"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                status, response = self._dispatch(method, path, body)
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                await self._respond(writer, status, response, close=close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, method: str, path: str, body: bytes):
+        if path != "/events":
+            return 404, {"error": f"unknown path: {path}"}
+        if method != "POST":
+            return 405, {"error": f"method not allowed: {method}"}
+
+        try:
+            payload = json.loads(body or b"null")
+        except ValueError as e:
+            return 400, {"error": f"invalid JSON: {e}"}
+        items = payload if isinstance(payload, list) else [payload]
+
+        ops, rejected = [], []
+        for i, item in enumerate(items):
+            try:
+                ops.append(self._parse_event(item))
+            except ValueError as e:
+                rejected.append({"index": i, "error": str(e)})
+
+        if len(ops) > self.QUEUE_SIZE:
+            # would never fit, the device must split it
+            return 413, {"error": f"too many events, at most {self.QUEUE_SIZE} per request"}
+        if len(ops) > self.QUEUE_SIZE - self._queue.qsize():
+            return 503, {"error": "too many events, retry later", "retry_after": self.RETRY_AFTER}
+        for op in ops:
+            self._queue.put_nowait(op)
+
+        return (202 if len(ops) > 0 else 422), {"accepted": len(ops), "rejected": rejected}
+
+    def _parse_event(self, item):
+        if not isinstance(item, dict):
+            raise ValueError("event must be an object")
+
+        plate, action, time = item.get("plate"), item.get("action"), item.get("time")
+        if action not in self.ACTIONS:
+            raise ValueError(f"unknown action: {action}")
+        if plate not in self.journal.roster:
+            raise ValueError(f"unknown licence plate: {plate}")
+        try:
+            time = datetime.fromisoformat(time) if time else datetime.now()
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid time: {time}")
+        if time.tzinfo is not None:
+            # journal keeps naive local times
+            time = time.astimezone().replace(tzinfo=None)
+        return action, plate, time
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, payload, close: bool = False):
+        reasons = {202: "Accepted", 400: "Bad Request", 404: "Not Found",
+                   405: "Method Not Allowed", 413: "Payload Too Large",
+                   422: "Unprocessable Entity", 503: "Service Unavailable"}
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {reasons.get(status, '')}",
+                "Content-Type: application/json; charset=utf-8",
+                f"Content-Length: {len(body)}",
+                f"Connection: {'close' if close else 'keep-alive'}"]
+        if status == 503:
+            head.append(f"Retry-After: {self.RETRY_AFTER}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+INGESTION_HOST = os.environ.get("VEHICLE_JOURNAL_API_HOST", "127.0.0.1")
+INGESTION_PORT = int(os.environ.get("VEHICLE_JOURNAL_API_PORT", 8600))
+
+
+@st.cache_resource
+def start_ingestion_server(_journal: JournalStore, host: str, port: int) -> IngestionServer:
+    return IngestionServer(_journal, host, port).start()
+
+
+@dataclass
+class Job:
+    JOURNAL = "journal"
+    EXPORT = "export"
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # states displayed to user
+    STATUS = {RUNNING: "оновлюється", FAILED: "помилка"}
+
+    title: str = ""
+    # tag (e.g. journal version) of the latest run
+    tag: typ.Any = None
+    state: str = PENDING
+    # result of the latest successful run and its tag
+    result: typ.Any = None
+    result_tag: typ.Any = None
+    error: str = None
+    finished_at: datetime = None
+    # last time a session looked the job up
+    used_at: datetime = None
+
+
+class BackgroundJobs:
+    """Runs slow work (journal persistence, export, aggregations) in a thread
+    pool, off the UI path.
+
+    Jobs are keyed, a job is submitted with a tag (e.g. journal version) and
+    redundant runs are coalesced: a key is never run concurrently, if it is
+    running only the latest submitted run is queued after it, and a tag that
+    is already submitted is skipped (a failed one is retried after
+    `RETRY_FAILED_AFTER`). The result of the latest successful run is kept
+    until the next one finishes. `version` is bumped whenever a job finishes
+    (unless it fails again with the same error), so sessions know when to
+    rerun. Jobs no session looked up for `EVICT_AFTER` (e.g. of a replaced
+    roster) are dropped together with their result files.
+    """
+
+    RETRY_FAILED_AFTER = timedelta(seconds=30)
+    EVICT_AFTER = timedelta(minutes=30)
+
+    TITLES = {Job.JOURNAL: "Журнал", Job.EXPORT: "Завантаження"}
+
+    def __init__(self, max_workers: int = 2) -> None:
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="jobs")
+        self._lock = threading.RLock()
+        self._jobs = {}
+        # key -> (tag, fn, args) waiting for a running job
+        self._queued = {}
+        self.version = 0
+
+    def submit(self, key, tag, fn: typ.Callable, *args):
+        with self._lock:
+            self._evict()
+            job = self.status(key)
+            if key in self._queued:
+                if self._queued[key][0] == tag:
+                    return
+            elif job.tag == tag and (job.state != Job.FAILED or
+                                     datetime.now() - job.finished_at < self.RETRY_FAILED_AFTER):
+                return
+
+            self._queued[key] = (tag, fn, args)
+            if job.state != Job.RUNNING:
+                self._start(key)
+
+    def status(self, key) -> Job:
+        with self._lock:
+            if key not in self._jobs:
+                name = key[0] if isinstance(key, tuple) else key
+                self._jobs[key] = Job(title=self.TITLES.get(name, str(name)))
+            job = self._jobs[key]
+            job.used_at = datetime.now()
+            return job
+
+    def _evict(self):
+        unused_since = datetime.now() - self.EVICT_AFTER
+        for key, job in list(self._jobs.items()):
+            if job.state == Job.RUNNING or key in self._queued or job.used_at >= unused_since:
+                continue
+            del self._jobs[key]
+            if isinstance(job.result, Path):
+                job.result.unlink(missing_ok=True)
+
+    def _start(self, key):
+        tag, fn, args = self._queued.pop(key)
+        job = self._jobs[key]
+        job.tag, job.state = tag, Job.RUNNING
+        self._executor.submit(self._run, key, tag, fn, args)
+
+    def _run(self, key, tag, fn: typ.Callable, args):
+        try:
+            result, error = fn(*args), None
+        except Exception as e:
+            result, error = None, e
+
+        with self._lock:
+            job = self._jobs[key]
+            repeated = False
+            if error is None:
+                job.state, job.result, job.result_tag, job.error = Job.DONE, result, tag, None
+            else:
+                error = f"{type(error).__name__}: {error}"
+                repeated = job.error == error
+                job.state, job.error = Job.FAILED, error
+            job.finished_at = datetime.now()
+            if not repeated:
+                self.version += 1
+
+            if key in self._queued:
+                self._start(key)
+
+
+@st.cache_resource
+def start_background_jobs() -> BackgroundJobs:
+    # exports of previous runs are not referenced by any job
+    for export_file in EXPORT_DIR.glob("journal_*.xlsx"):
+        export_file.unlink(missing_ok=True)
+    return BackgroundJobs()
+
+
+def journal_trips(journal: JournalStore) -> typ.List[typ.Tuple[str, datetime, datetime]]:
+    """Copy of journal trips `(plate, check out time, check in time)`, newest
+    first (taken under the lock, to be formatted after releasing it)"""
+    with journal.lock:
+        return [(plate, record.check_out_time, record.check_in_time)
+                for plate, record in journal.index.ordered(newest_first=True)]
+
+
+def journal_rows(journal: JournalStore,
+                 vehicles: pd.DataFrame,
+                 trips: typ.Iterable[typ.Tuple[str, datetime, datetime]]):
+    """Journal rows (in columns of the roster `vehicles`) of `trips`
+    `(plate, check out time, check in time)`, formatted one by one; details
+    of vehicles are taken from the roster and the journal"""
+    columns = list(vehicles.columns)
+    plate_idx = columns.index(VehicleJournalTable.LICENCE_PLATE)
+    check_out_idx = columns.index(VehicleJournalTable.TIME_CHECK_OUT)
+    check_in_idx = columns.index(VehicleJournalTable.TIME_CHECK_IN)
+
+    # `journal.vehicles` is replaced (never modified) on changes
+    with journal.lock:
+        journal_vehicles = journal.vehicles
+
+    # details of vehicles, the roster takes precedence
+    details = {}
+    for df in [journal_vehicles.reindex(columns=columns), vehicles]:
+        for row in df.itertuples(index=False, name=None):
+            details[row[plate_idx]] = row
+
+    for plate, check_out_time, check_in_time in trips:
+        if plate not in details:
+            continue
+        row = list(details[plate])
+        row[check_out_idx] = check_out_time.strftime(datetime_format) \
+            if isinstance(check_out_time, datetime) else TIME_NOT_SET
+        row[check_in_idx] = check_in_time.strftime(datetime_format) \
+            if isinstance(check_in_time, datetime) else TIME_NOT_SET
+        yield row
+
+
+def journal_df(journal: JournalStore,
+               vehicles: pd.DataFrame,
+               trips: typ.Iterable[typ.Tuple[str, datetime, datetime]],
+               columns_name_mapping) -> pd.DataFrame:
+    """Journal dataframe of `trips` `(plate, check out time, check in time)`,
+    details of vehicles are taken from the roster `vehicles` and the journal"""
+    df = pd.DataFrame(list(journal_rows(journal, vehicles, trips)), columns=list(vehicles.columns))
+    df.rename(columns={v: k for k, v in columns_name_mapping.items()}, inplace=True)
+    return df
+
+
+def build_journal(journal: JournalStore,
+                  version: int,
+                  vehicles: pd.DataFrame,
+                  columns_name_mapping) -> pd.DataFrame:
+    """Convert `events` to journal dataframe (newest first) and save it"""
+    df = journal_df(journal, vehicles, journal_trips(journal), columns_name_mapping)
+
+    journal.persist(df, version)
+    return df
+
+
+EXPORT_DIR = Path(tempfile.gettempdir()) / "vehicle-journal"
+
+
+def build_export(journal: JournalStore,
+                 vehicles: pd.DataFrame,
+                 split: str,
+                 columns_name_mapping,
+                 name: str) -> Path:
+    """Export the journal (newest first) to Excel file `name` (split into
+    sheets by `split`), rows are formatted as they are written"""
+    columns = list(vehicles.columns)
+    sheet_key = None
+    if split != ExportSplit.NONE:
+        # check out time is formatted as `datetime_format` (ends with date)
+        date_length = len("dd.mm.YYYY") if split == ExportSplit.DAY else len("mm.YYYY")
+        check_out_idx = columns.index(VehicleJournalTable.TIME_CHECK_OUT)
+        sheet_key = lambda row: \
+            row[check_out_idx][-date_length:] if row[check_out_idx] != TIME_NOT_SET else None
+
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    export_file = EXPORT_DIR / f"{name}.xlsx"
+
+    # replace the previous export only when the new one is complete
+    tmp_file = export_file.with_suffix(".tmp.xlsx")
+    inv_columns_name_mapping = {v: k for k, v in columns_name_mapping.items()}
+    export_to_excel(journal_rows(journal, vehicles, journal_trips(journal)),
+                    [inv_columns_name_mapping.get(c, c) for c in columns],
+                    str(tmp_file),
+                    sheet_key=sheet_key)
+    os.replace(tmp_file, export_file)
+    return export_file
+
+
+class ExportSplit:
+    NONE = "Один аркуш"
+    DAY = "По днях"
+    MONTH = "По місяцях"
+
+    @classmethod
+    def items(cls):
+        return [
+            cls.NONE, cls.DAY, cls.MONTH
+        ]
 
 
 class Page:
@@ -207,19 +1399,25 @@ def clear_confirmation_text():
     st.session_state["clear_confirmation_text"] = ""
 
 
-def display_vehicles_page(events,
+def display_vehicles_page(journal,
+                          overdue_plates,
                           vehicles,
                           skip_columns,
                           short_data_columns):
+    events = journal.events
     display_columns = [c for c in vehicles.columns if c not in skip_columns]
 
-    lplate_search_cont, _, page_prev, page_num, page_next, items_per_page_cont = \
-        st.columns([5, 15, 1, 2, 1, 3])
+    lplate_search_cont, overdue_cont, _, page_prev, page_num, page_next, items_per_page_cont = \
+        st.columns([5, 3, 12, 1, 2, 1, 3])
     license_plate_options = set(lplate_search_cont.multiselect(
         "Пошук за номером",
         options=vehicles[VehicleJournalTable.LICENCE_PLATE].to_list()
     ))
 
+    for i in range(2):
+        overdue_cont.text('')
+    only_overdue = overdue_cont.checkbox(f"Прострочені [{len(overdue_plates)}]")
+
 
     items_per_page = items_per_page_cont.selectbox(
         "Кількість авто на сторінці",
@@ -261,6 +1459,10 @@ def display_vehicles_page(events,
         vehicles_data_filtered = vehicles_data.loc[
             vehicles_data[VehicleJournalTable.LICENCE_PLATE
         ].isin(license_plate_options)]
+    if only_overdue:
+        vehicles_data_filtered = vehicles_data_filtered.loc[
+            vehicles_data_filtered[VehicleJournalTable.LICENCE_PLATE
+        ].isin(overdue_plates)]
 
     for i in range(1):
         page_num.text('')
@@ -278,15 +1480,19 @@ def display_vehicles_page(events,
         containers = st.columns(sizes)
 
         # check-out button p
+        # changes are committed in callbacks (before the rerun), so every
+        # row is rendered from the same journal version
         column_type = Controls.CHECK_OUT
-        if containers[indexes[column_type]].button(column_type,
-                                                   key=f"{column_type}:{idx}"):
-            events[idx].check_out()
+        containers[indexes[column_type]].button(column_type,
+                                                key=f"{column_type}:{idx}",
+                                                on_click=journal.check_out,
+                                                args=(idx,))
 
         column_type = Controls.CHECK_IN
-        if containers[indexes[column_type]].button(column_type,
-                                               key=f"{column_type}:{idx}"):
-            events[idx].check_in()
+        containers[indexes[column_type]].button(column_type,
+                                                key=f"{column_type}:{idx}",
+                                                on_click=journal.check_in,
+                                                args=(idx,))
 
         color = 'green' if events[idx].checked_in else 'red'
         for col in vehicles_data.columns:
@@ -374,15 +1580,27 @@ def main():
 
     page = st.sidebar.radio("Сторінка", Page.items())
 
-    # load events from history (cache)
-    # if 'events' not in st.session_state:
-    events, events_vehicles = load_events(str(log_file),
-                                          columns_name_mapping)
+    # load events from history (snapshot + operations log, once per process)
+    journal = open_journal(str(log_file), columns_name_mapping)
+    events = journal.events
+    overdue = track_overdue(journal)
+    trips = index_trips(journal)
+    jobs = start_background_jobs()
+
+    # events from gate devices
+    try:
+        start_ingestion_server(journal, INGESTION_HOST, INGESTION_PORT)
+    except OSError as e:
+        st.sidebar.warning(f"API ({INGESTION_HOST}:{INGESTION_PORT}) недоступний: {e}")
     st.sidebar.markdown("---")
 
     cnt_stats_header = st.sidebar.empty()
     cnt_stats = st.sidebar.empty()
+    overdue_alerts = st.sidebar.container()
+    export_split = st.sidebar.selectbox("Аркуші (журнал)", ExportSplit.items())
+    btn_prepare = st.sidebar.empty()
     btn_load = st.sidebar.empty()
+    jobs_status = st.sidebar.container()
 
      # clear all button
     st.sidebar.markdown("""---""")
@@ -394,27 +1612,32 @@ def main():
     if st.sidebar.button(Controls.CLEAR_ALL,
                          disabled=(clear_confirmation not in text.lower()),
                          on_click=clear_confirmation_text):
-        for e in events.values():
-            e.clear()
-            events_vehicles.drop(events_vehicles.index, inplace=True)
+        journal.clear()
 
     st.sidebar.markdown("""---""")
 
 
     # clear (checked-in) button
     if st.sidebar.button(Controls.CLEAR_CHECKED_IN):
-        for e in events.values():
-            e.clear_checked_in()
-            events_vehicles = \
-                events_vehicles[events_vehicles[VehicleJournalTable.TIME_CHECK_IN] == TIME_NOT_SET]
+        journal.clear_checked_in()
 
     st.sidebar.markdown("""---""")
 
+    # everything below is rendered from this version of the journal
+    journal_version = journal.version
+    st.session_state["journal_version"] = journal_version
+    st.session_state["journal_rendered_at"] = datetime.now()
+    st.session_state["jobs_version"] = jobs.version
+    watch_journal(journal, overdue, jobs)
+
     skip_columns = set([VehicleJournalTable.GROUP_OF_OPERATION,
                         VehicleJournalTable.VEHICLE_PURPOSE])
 
     # add columns for state (`check_in`, `check_out`)
     data_columns = list(vehicles.columns)
+    journal.set_roster(vehicles[data_columns])
+    overdue.set_groups(vehicles)
+    overdue_trips = overdue.overdue()
     short_data_columns = [c for c in data_columns if c not in skip_columns]
     for i, (column, control) in enumerate(
             zip([VehicleJournalTable.TIME_CHECK_OUT,
@@ -428,52 +1651,53 @@ def main():
     if page == Page.VEHICLES:
         # st.markdown(f"<h1 style='text-align: center'> {header} </h1>", unsafe_allow_html=True)
         st.header(header)
-        display_vehicles_page(events, vehicles, skip_columns, short_data_columns)
-
-    # convert `events` to dataframe
-    events_df = []
-    events_df.extend(events_to_df(events, vehicles[data_columns]))
-
-    vehicles_license_plates = set(vehicles[VehicleJournalTable.LICENCE_PLATE])
-    events_df.extend(
-        events_to_df(
-            events,
-            events_vehicles[~events_vehicles[VehicleJournalTable.LICENCE_PLATE].isin(vehicles_license_plates)]
-        )
+        display_vehicles_page(journal,
+                              {plate for _, _, plate in overdue_trips},
+                              vehicles,
+                              skip_columns,
+                              short_data_columns)
+
+    with journal.lock:
+        num_checked_out = sum([len(logs) > 0 and not logs.checked_in for logs in events.values()])
+
+    # convert `events` to dataframe and save it (in background)
+    inv_columns_name_mapping = {v: k for k, v in columns_name_mapping.items()}
+    # jobs are shared by sessions, while the journal depends on the roster
+    roster = vehicles[data_columns]
+    roster_id = "{:08x}{:016x}".format(
+        zlib.crc32("\t".join(map(str, data_columns)).encode("utf-8")),
+        int(pd.util.hash_pandas_object(roster, index=False).sum()))
+    jobs.submit((Job.JOURNAL, roster_id), journal_version,
+                build_journal, journal, journal_version, roster, columns_name_mapping)
+    journal_job = jobs.status((Job.JOURNAL, roster_id))
+    df = journal_job.result
+
+    # convert to Excel (in background) on request, the file is kept until the next one
+    export_key = (Job.EXPORT, roster_id, export_split)
+    if btn_prepare.button(Controls.PREPARE_DOWNLOAD):
+        jobs.submit(export_key, journal_version,
+                    build_export, journal, roster, export_split, columns_name_mapping,
+                    f"journal_{roster_id}_{ExportSplit.items().index(export_split)}")
+    export_job = jobs.status(export_key)
+
+    elem_name = Controls.DOWNLOAD
+    export_ready = export_job.result is not None
+    if export_ready and export_job.state == Job.DONE:
+        elem_name = f"{elem_name} ({export_job.finished_at.strftime(datetime_format)})"
+    btn_load.download_button(
+        label=elem_name,
+        data=partial(Path.read_bytes, Path(export_job.result)) if export_ready else b"",
+        file_name=f"events_{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.xlsx",
+        mime="application/vnd.ms-excel",
+        disabled=not export_ready
     )
 
-    df = pd.DataFrame(events_df, columns=data_columns)
+    for job in [journal_job, export_job]:
+        if job.state in Job.STATUS:
+            jobs_status.caption(f"{job.title}: {Job.STATUS[job.state]}")
+        if job.state == Job.FAILED:
+            jobs_status.error(job.error)
 
-    # sort by time
-    df = sort_by_check_out_time(df)
-    df.reset_index(drop=True, inplace=True)
-    df.rename(columns={v: k for k, v in columns_name_mapping.items()}, inplace=True)
-
-    df.to_csv(str(log_file), index=False)
-
-    # convert to Excel and Save to file
-    with io.BytesIO() as buffer:
-        with pd.ExcelWriter(buffer) as writer:
-            # Convert the dataframe to an XlsxWriter Excel object.
-
-            df.to_excel(writer, index=False, sheet_name='Журнал')
-
-            # Auto-adjust columns' width
-            for column in df:
-                column_width = max(df[column].astype(str).map(len).max(), len(column))
-                col_idx = df.columns.get_loc(column)
-                writer.sheets['Журнал'].set_column(col_idx, col_idx, column_width)
-
-        elem_name = Controls.DOWNLOAD
-        btn_load.download_button(
-            label=elem_name,
-            data=buffer.getvalue(),
-            file_name=f"events_{datetime.now().strftime('%d-%m-%Y_%H-%M-%S')}.xlsx",
-            mime="application/vnd.ms-excel",
-            disabled=len(df) <= 0
-        )
-
-    num_checked_out = sum([len(logs) > 0 and not logs.checked_in for logs in events.values()])
     num_vehicles_total = num_vehicles_total or len(vehicles)
 
     cnt_stats_header.subheader("Кількість")
@@ -487,16 +1711,73 @@ def main():
         columns[0].text(k)
         columns[1].text(v)
 
+    # overdue vehicles (most overdue first)
+    max_overdue_alerts = 20
+    if len(overdue_trips) > 0:
+        overdue_alerts.error(f"Прострочені [{len(overdue_trips)}]")
+        for deadline, check_out_time, plate in overdue_trips[:max_overdue_alerts]:
+            overdue_alerts.markdown(
+                f"**{plate}** - виїзд {check_out_time.strftime(datetime_format)}, "
+                f"термін {deadline.strftime(datetime_format)}")
+        if len(overdue_trips) > max_overdue_alerts:
+            overdue_alerts.markdown(f"... та ще {len(overdue_trips) - max_overdue_alerts}")
+
+    next_due = overdue.next_due()
+    if next_due:
+        deadline, _, plate = next_due
+        overdue_alerts.info(f"Наступна: **{plate}** до {deadline.strftime(datetime_format)}")
+
 
     # display table
     if page == Page.JOURNAL:
-        st.header(f"Журнал [{len(df)}]")
+        # audit filter: vehicles out at a moment / during a period
+        filter_cont, date_from_cont, time_from_cont, date_to_cont, time_to_cont, latest_cont = \
+            st.columns([4, 2, 2, 2, 2, 2])
+        time_filter = filter_cont.radio("Фільтр", ["Усі", "На момент", "За період"],
+                                        horizontal=True)
+        num_latest = latest_cont.selectbox("Показати останні", [100, 1000, 10000, "Усі"])
+        with journal.lock:
+            num_records = len(journal.index)
+        if time_filter != "Усі":
+            time_from = datetime.combine(date_from_cont.date_input("Дата"),
+                                         time_from_cont.time_input("Час", step=60))
+            if time_filter == "На момент":
+                found_trips = trips.out_at(time_from)
+            else:
+                time_to = datetime.combine(date_to_cont.date_input("Дата (до)"),
+                                           time_to_cont.time_input("Час (до)", step=60))
+                found_trips = trips.out_between(time_from, time_to)
+
+            # newest first
+            found_trips = sorted(found_trips, key=lambda trip: trip[0], reverse=True)
+            df = journal_df(journal,
+                            roster,
+                            [(plate, check_out_time, check_in_time)
+                             for check_out_time, check_in_time, plate in found_trips],
+                            columns_name_mapping)
+        elif num_latest != "Усі":
+            # latest records straight from the journal (already ordered)
+            with journal.lock:
+                latest = [(plate, record.check_out_time, record.check_in_time)
+                          for plate, record in journal.index.latest(num_latest)]
+            df = journal_df(journal, roster, latest, columns_name_mapping)
+        elif df is not None:
+            # results of background jobs are shared, don't modify them
+            df = df.copy()
+
+    if page == Page.JOURNAL and df is None:
+        st.info("Журнал готується ...")
+    elif page == Page.JOURNAL:
+        st.header(f"Журнал [{len(df)} / {num_records}]")
+        if not journal.history_loaded.is_set():
+            st.info("Історія журналу завантажується ...")
 
-        inv_columns_name_mapping = {v: k for k, v in columns_name_mapping.items()}
         df.reset_index(drop=True, inplace=True)
         for c in df.columns:
             df[c] = df[c].astype(str)
         st.dataframe(df[[inv_columns_name_mapping[c] for c in short_data_columns]])
 
-main()
+
+if __name__ == "__main__":
+    main()
 
@@ -0,0 +1,212 @@
+"""Integration tests of the ingestion API against a local server."""
+import http.client
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from app import IngestionServer, JournalStore, VehicleJournalTable
+
+
+PLATES = [f"P{i:04d}" for i in range(1000)]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("condition was not met in time")
+        time.sleep(0.01)
+
+
+def open_journal(path):
+    return JournalStore(path / "log.csv", {})
+
+
+@pytest.fixture
+def journal(tmp_path):
+    (tmp_path / "log.csv").touch()
+    journal = open_journal(tmp_path)
+    journal.set_roster(pd.DataFrame({
+        VehicleJournalTable.ID: range(len(PLATES)),
+        VehicleJournalTable.LICENCE_PLATE: PLATES,
+    }))
+    return journal
+
+
+@pytest.fixture
+def server(journal):
+    server = IngestionServer(journal, "127.0.0.1", 0).start()
+    yield server
+    server.stop()
+
+
+def request(server, method="POST", path="/events", body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    if body is not None and not isinstance(body, (bytes, str)):
+        body = json.dumps(body)
+    connection.request(method, path, body=body, headers=headers or {})
+    response = connection.getresponse()
+    payload = json.loads(response.read())
+    connection.close()
+    return response, payload
+
+
+def test_single_event(server, journal):
+    response, payload = request(server, body={"plate": "P0001", "action": "check_out"})
+
+    assert response.status == 202
+    assert payload == {"accepted": 1, "rejected": []}
+    wait_for(lambda: journal.version == 1)
+    assert not journal.events["P0001"].checked_in
+
+
+def test_event_time(server, journal):
+    request(server, body={"plate": "P0001", "action": "check_out", "time": "2022-05-12T03:00:00"})
+    request(server, body={"plate": "P0002", "action": "check_out", "time": "2022-05-12T03:00:00Z"})
+    wait_for(lambda: journal.version == 2)
+
+    assert journal.events["P0001"].check_out_time == datetime(2022, 5, 12, 3)
+    # times with offset are converted to (naive) local time
+    expected = datetime(2022, 5, 12, 3, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    assert journal.events["P0002"].check_out_time == expected
+
+
+def test_validation(server, journal):
+    response, payload = request(server, body=[
+        {"plate": "UNKNOWN", "action": "check_out"},
+        {"plate": "P0001", "action": "drive"},
+        {"plate": "P0001", "action": "check_in", "time": "yesterday"},
+        "P0001",
+        {"plate": "P0002", "action": "check_out"},
+    ])
+
+    assert response.status == 202
+    assert payload["accepted"] == 1
+    assert [r["index"] for r in payload["rejected"]] == [0, 1, 2, 3]
+    wait_for(lambda: journal.version == 1)
+
+    response, payload = request(server, body={"plate": "UNKNOWN", "action": "check_out"})
+    assert response.status == 422
+    assert payload["accepted"] == 0
+
+
+@pytest.mark.parametrize("method, path, body, headers, status", [
+    ("POST", "/events", "{not json", None, 400),
+    ("POST", "/events", "{}", {"Content-Length": "abc"}, 400),
+    ("POST", "/other", "{}", None, 404),
+    ("GET", "/events", None, None, 405),
+])
+def test_bad_requests(server, method, path, body, headers, status):
+    if headers:
+        # send the raw request, http.client would set Content-Length itself
+        connection = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+        connection.putrequest(method, path, skip_accept_encoding=True)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.endheaders(body.encode())
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+    else:
+        response, _ = request(server, method, path, body)
+    assert response.status == status
+
+
+def test_batching(server, journal):
+    batches = []
+    commit = journal.commit
+
+    def record_commit(ops):
+        batches.append(len(ops))
+        commit(ops)
+
+    journal.commit = record_commit
+
+    events = [{"plate": plate, "action": "check_out"} for plate in PLATES]
+    for i in range(0, len(events), 100):
+        response, _ = request(server, body=events[i:i + 100])
+        assert response.status == 202
+
+    wait_for(lambda: journal.version == len(events))
+    assert sum(batches) == len(events)
+    assert max(batches) > 1
+    assert max(batches) <= IngestionServer.BATCH_SIZE
+    assert all(not journal.events[plate].checked_in for plate in PLATES)
+
+
+def test_backpressure(journal):
+    release = threading.Event()
+    commit = journal.commit
+
+    def blocked_commit(ops):
+        release.wait()
+        commit(ops)
+
+    journal.commit = blocked_commit
+
+    server = IngestionServer(journal, "127.0.0.1", 0)
+    server.QUEUE_SIZE = 10
+    server.start()
+    try:
+        # first event is taken by the (blocked) consumer, next 10 fill the queue
+        request(server, body={"plate": PLATES[0], "action": "check_out"})
+        wait_for(lambda: server._queue.empty())
+        response, _ = request(server, body=[{"plate": p, "action": "check_out"} for p in PLATES[1:11]])
+        assert response.status == 202
+
+        response, payload = request(server, body={"plate": PLATES[11], "action": "check_out"})
+        assert response.status == 503
+        assert response.getheader("Retry-After") == str(IngestionServer.RETRY_AFTER)
+
+        # more events than the queue holds are never accepted
+        response, _ = request(server, body=[{"plate": p, "action": "check_out"} for p in PLATES[:11]])
+        assert response.status == 413
+
+        release.set()
+        wait_for(lambda: journal.version == 11)
+        response, _ = request(server, body={"plate": PLATES[11], "action": "check_out"})
+        assert response.status == 202
+        wait_for(lambda: journal.version == 12)
+    finally:
+        release.set()
+        server.stop()
+
+
+def test_failed_batch_does_not_stop_ingestion(server, journal):
+    commit = journal.commit
+    failures = [RuntimeError("disk is full")]
+
+    def failing_commit(ops):
+        if failures:
+            raise failures.pop()
+        commit(ops)
+
+    journal.commit = failing_commit
+
+    request(server, body={"plate": "P0001", "action": "check_out"})
+    request(server, body={"plate": "P0002", "action": "check_out"})
+    wait_for(lambda: journal.version == 2)
+    assert server.dropped == 0
+
+
+def test_replay(server, journal, tmp_path):
+    request(server, body=[{"plate": plate, "action": "check_out"} for plate in PLATES[:300]])
+    request(server, body=[{"plate": plate, "action": "check_in"} for plate in PLATES[:100]])
+    wait_for(lambda: journal.version == 400)
+
+    def state(journal):
+        return {plate: [(r.check_out_time, r.check_in_time) for r in logs]
+                for plate, logs in journal.events.items() if len(logs) > 0}
+
+    # snapshot plus tail of the operations log, then the older history
+    reopened = open_journal(tmp_path)
+    assert reopened.history_loaded.wait(5)
+    assert state(reopened) == state(journal)
+
+    # full rebuild from the operations log
+    (tmp_path / "log.snapshot").unlink()
+    assert state(open_journal(tmp_path)) == state(journal)
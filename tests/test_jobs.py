@@ -0,0 +1,37 @@
+"""Background jobs: coalescing and eviction of unused jobs."""
+import time
+from datetime import datetime, timedelta
+
+from app import BackgroundJobs, Job
+
+
+def wait_done(jobs, key, timeout=5.0):
+    deadline = time.time() + timeout
+    while jobs.status(key).state != Job.DONE:
+        assert time.time() < deadline, "job did not finish in time"
+        time.sleep(0.01)
+    return jobs.status(key)
+
+
+def test_same_tag_is_run_once():
+    jobs = BackgroundJobs()
+    runs = []
+    jobs.submit((Job.JOURNAL, "a"), 1, runs.append, 1)
+    wait_done(jobs, (Job.JOURNAL, "a"))
+    jobs.submit((Job.JOURNAL, "a"), 1, runs.append, 1)
+    jobs.submit((Job.JOURNAL, "a"), 2, runs.append, 2)
+    wait_done(jobs, (Job.JOURNAL, "a"))
+    time.sleep(0.05)
+    assert runs == [1, 2]
+
+
+def test_unused_jobs_are_evicted(tmp_path):
+    jobs = BackgroundJobs()
+    export_file = tmp_path / "journal.xlsx"
+    export_file.touch()
+    jobs.submit((Job.EXPORT, "old"), 1, lambda: export_file)
+    wait_done(jobs, (Job.EXPORT, "old")).used_at = datetime.now() - jobs.EVICT_AFTER - timedelta(seconds=1)
+
+    jobs.submit((Job.EXPORT, "new"), 1, lambda: None)
+    assert set(jobs._jobs) == {(Job.EXPORT, "new")}
+    assert not export_file.exists()
@@ -0,0 +1,96 @@
+"""Journal store persistence: snapshot plus operations log."""
+import os
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from app import JournalStore
+
+
+def open_journal(path):
+    return JournalStore(path / "log.csv", {})
+
+
+def state(journal):
+    return {plate: [(r.check_out_time, r.check_in_time) for r in logs]
+            for plate, logs in journal.events.items() if len(logs) > 0}
+
+
+@pytest.fixture
+def kyiv_time():
+    tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Kyiv"
+    time.tzset()
+    yield
+    if tz is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = tz
+    time.tzset()
+
+
+def test_snapshot_keeps_local_times(tmp_path, kyiv_time):
+    (tmp_path / "log.csv").touch()
+    journal = open_journal(tmp_path)
+    # skipped (spring) and repeated (autumn) hours of the DST transitions
+    journal.check_out("P1", datetime(2022, 3, 27, 3, 30))
+    journal.check_in("P1", datetime(2022, 10, 30, 3, 30))
+    journal.snapshot()
+
+    (tmp_path / "log.ops").unlink()
+    assert state(open_journal(tmp_path)) == {
+        "P1": [(datetime(2022, 3, 27, 3, 30), datetime(2022, 10, 30, 3, 30))],
+    }
+
+
+@pytest.fixture
+def journal(tmp_path):
+    (tmp_path / "log.csv").touch()
+    journal = open_journal(tmp_path)
+    for day in range(1, 4):
+        for plate in ["P1", "P2", "P3"]:
+            journal.check_out(plate, datetime(2024, 1, day, 8))
+            journal.check_in(plate, datetime(2024, 1, day, 18))
+    journal.check_out("P1", datetime(2024, 1, 4, 8))
+    journal.snapshot()
+    return journal
+
+
+@pytest.fixture
+def held_history(monkeypatch):
+    """History of reopened journals is merged once the event is set"""
+    release = threading.Event()
+    load_history = JournalStore._load_history
+
+    def held(self, ops_offset):
+        release.wait(5)
+        load_history(self, ops_offset)
+
+    monkeypatch.setattr(JournalStore, "_load_history", held)
+    return release
+
+
+def test_startup_loads_last_records(tmp_path, journal, held_history):
+    reopened = open_journal(tmp_path)
+    assert not reopened.history_loaded.is_set()
+    assert {plate: len(logs) for plate, logs in reopened.events.items()} == {"P1": 1, "P2": 1, "P3": 1}
+    assert reopened.events["P1"].check_out_time == datetime(2024, 1, 4, 8)
+
+    held_history.set()
+    assert reopened.history_loaded.wait(5)
+    assert state(reopened) == state(journal)
+    times = [record.check_out_time for _, record in reopened.index.ordered()]
+    assert times == sorted(times, reverse=True) and len(times) == 10
+
+
+def test_clear_before_history_is_loaded(tmp_path, journal, held_history):
+    reopened = open_journal(tmp_path)
+    reopened.clear_checked_in()
+    journal.clear_checked_in()
+
+    held_history.set()
+    assert reopened.history_loaded.wait(5)
+    assert state(reopened) == state(journal) == {"P1": [(datetime(2024, 1, 4, 8), None)]}
+    assert len(reopened.index) == 1
@@ -0,0 +1,92 @@
+"""Trip interval index queries against a brute-force scan of the journal."""
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from app import JournalOp, JournalStore, TripIntervalIndex, VehicleJournalTable
+
+
+PLATES = [f"P{i:02d}" for i in range(20)]
+START = datetime(2024, 1, 1, 8)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    (tmp_path / "log.csv").touch()
+    journal = JournalStore(tmp_path / "log.csv", {})
+    journal.set_roster(pd.DataFrame({
+        VehicleJournalTable.ID: range(len(PLATES)),
+        VehicleJournalTable.LICENCE_PLATE: PLATES,
+    }))
+    return journal
+
+
+def brute_force(journal, start, end):
+    found = []
+    for plate, logs in journal.events.items():
+        for item in logs:
+            if not item.check_out_time:
+                continue
+            if item.checked_in:
+                check_in = max(item.check_out_time, item.check_in_time)
+                if item.check_out_time <= end and check_in >= start:
+                    found.append((item.check_out_time, check_in, plate))
+            elif item.check_out_time <= end and start <= datetime.now():
+                found.append((item.check_out_time, None, plate))
+    return sorted(found, key=str)
+
+
+def random_ops(rng, count):
+    time = START
+    for _ in range(count):
+        time += timedelta(minutes=rng.randint(1, 30))
+        op = rng.choice([JournalOp.CHECK_OUT, JournalOp.CHECK_IN])
+        # backdated events, e.g. a check in before its check out
+        backdate = timedelta(hours=rng.randint(1, 5)) if rng.random() < 0.2 else timedelta()
+        yield op, rng.choice(PLATES), time - backdate
+
+
+def assert_matches(index, journal, rng, times):
+    for _ in range(50):
+        start = rng.choice(times) + timedelta(seconds=rng.choice([-1, 0, 1]))
+        end = start + timedelta(minutes=rng.choice([0, 0, 10, 120]))
+        assert sorted(index.out_between(start, end), key=str) == brute_force(journal, start, end)
+        assert sorted(index.out_at(start), key=str) == brute_force(journal, start, start)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_brute_force(journal, seed):
+    rng = random.Random(seed)
+    index = TripIntervalIndex(journal)
+    times = []
+    for _ in range(10):
+        ops = list(random_ops(rng, 100))
+        times.extend(time for _, _, time in ops)
+        journal.commit(ops)
+        assert_matches(index, journal, rng, times)
+
+
+def test_check_in_before_check_out(journal):
+    index = TripIntervalIndex(journal)
+    journal.check_out("P01", datetime(2024, 1, 1, 10))
+    journal.check_in("P01", datetime(2024, 1, 1, 9))
+
+    assert index.out_at(datetime(2024, 1, 1, 9, 30)) == []
+    assert index.out_at(datetime(2024, 1, 1, 10)) == [
+        (datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 10), "P01"),
+    ]
+
+
+def test_repeated_check_in_and_clear(journal):
+    index = TripIntervalIndex(journal)
+    journal.check_out("P01", datetime(2024, 1, 1, 10))
+    journal.check_in("P01", datetime(2024, 1, 1, 11))
+    journal.check_in("P01", datetime(2024, 1, 1, 12))
+    assert index.out_at(datetime(2024, 1, 1, 11, 30)) == [
+        (datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 12), "P01"),
+    ]
+
+    journal.clear_checked_in()
+    assert index.out_at(datetime(2024, 1, 1, 11, 30)) == []